@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Kalman-smoother imputation of the EMA items, the same model as the
+# `na_kalman(model = "StructTS", smooth = TRUE)` step in 01_EMA_idio_processing.Rmd.
+# Reads every Data/<ID>/<ID>_rawwithtime<date>.csv and writes
+# Data/<ID>/<ID>_imputed_rawwithtime<date>.csv next to it.
+
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import minimize
+
+DATA_PATH = "Data"
+CACHE_PATH = os.path.join(DATA_PATH, ".cache", "kalman")
+ITEM_START = 9  # dat_2[10:ncol(dat_2)] in the Rmd; the first 9 columns are time/beep variables
+MODEL = "trend"  # StructTS on a non-seasonal series is the local linear trend model; "level" is also supported
+MAX_WORKERS = None  # None uses one process per CPU
+
+# Transition matrix per model; each state variable gets its own variance, plus the observation variance
+MODELS = {
+    "level": np.array([[1.0]]),
+    "trend": np.array([[1.0, 1.0], [0.0, 1.0]]),
+}
+
+
+# Kalman filter over k series at once
+def kalman_filter(y, params, model, keep=False):
+    T = MODELS[model]
+    m = T.shape[0]
+    k, n = y.shape
+    Q = np.zeros((k, m, m))
+    for i in range(m):
+        Q[:, i, i] = params[:, i]
+    H = params[:, m]
+
+    first = np.array([row[~np.isnan(row)][0] for row in y])
+    a = np.zeros((k, m))
+    a[:, 0] = first
+    P = np.eye(m)[None, :, :] * (1e6 * np.nanvar(y, axis=1, ddof=1))[:, None, None]
+
+    nll = np.zeros(k)
+    seen = np.zeros(k, dtype=int)
+    if keep:
+        aPred, PPred = np.empty((n, k, m)), np.empty((n, k, m, m))
+        aFilt, PFilt = np.empty((n, k, m)), np.empty((n, k, m, m))
+
+    for t in range(n):
+        if keep:
+            aPred[t], PPred[t] = a, P
+
+        obs = ~np.isnan(y[:, t])
+        v = np.where(obs, y[:, t] - a[:, 0], 0.0)
+        F = np.maximum(P[:, 0, 0] + H, 1e-12)
+        K = P[:, :, 0] / F[:, None]
+
+        a = a + np.where(obs[:, None], K * v[:, None], 0.0)
+        P = P - np.where(obs[:, None, None], K[:, :, None] * P[:, 0, :][:, None, :], 0.0)
+
+        # The first m observations only fix the diffuse initial state
+        counted = obs & (seen >= m)
+        nll += np.where(counted, 0.5 * (np.log(F) + v ** 2 / F), 0.0)
+        seen += obs
+
+        if keep:
+            aFilt[t], PFilt[t] = a, P
+
+        a = a @ T.T
+        P = T @ P @ T.T + Q
+
+    if keep:
+        return nll, (aPred, PPred, aFilt, PFilt)
+    return nll
+
+
+# Rauch-Tung-Striebel smoother on the stored filter output, returns the smoothed level
+def kalman_smooth(y, params, model):
+    T = MODELS[model]
+    _, (aPred, PPred, aFilt, PFilt) = kalman_filter(y, params, model, keep=True)
+
+    n = y.shape[1]
+    aSmooth = aFilt[n - 1]
+    level = np.empty_like(y)
+    level[:, n - 1] = aSmooth[:, 0]
+    for t in range(n - 2, -1, -1):
+        J = PFilt[t] @ T.T @ np.linalg.pinv(PPred[t + 1])
+        aSmooth = aFilt[t] + np.einsum("kij,kj->ki", J, aSmooth - aPred[t + 1])
+        level[:, t] = aSmooth[:, 0]
+    return level
+
+
+# Maximum likelihood fit of the variances for k series at once. Variances are fitted
+# on the log scale in units of var(x) / 100 (StructTS scales them the same way); the
+# lower bound stands in for a variance of 0. The series are independent, so the joint
+# objective is the sum of per-series likelihoods and each finite-difference step
+# perturbs one parameter for every series in a single batched filter pass.
+def fit_params(y, model):
+    k = y.shape[0]
+    npar = MODELS[model].shape[0] + 1
+    vx = np.nanvar(y, axis=1, ddof=1)[:, None] / 100
+    step = 1e-5
+
+    def objective(theta):
+        theta = theta.reshape(k, npar)
+        base = kalman_filter(y, np.exp(theta) * vx, model)
+        grad = np.empty((k, npar))
+        for j in range(npar):
+            bumped = theta.copy()
+            bumped[:, j] += step
+            grad[:, j] = (kalman_filter(y, np.exp(bumped) * vx, model) - base) / step
+        return base.sum(), grad.ravel()
+
+    result = minimize(objective, np.zeros(k * npar), jac=True, method="L-BFGS-B",
+                      bounds=[(-20, 10)] * (k * npar), options={"maxiter": 3000})
+    return np.exp(result.x.reshape(k, npar)) * vx
+
+
+def cache_key(series, model):
+    return hashlib.sha1(model.encode() + np.ascontiguousarray(series, dtype=np.float64).tobytes()).hexdigest()
+
+
+def load_params(key):
+    path = os.path.join(CACHE_PATH, key + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path) as cacheFile:
+        return np.array(json.load(cacheFile))
+
+
+def save_params(key, params):
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    path = os.path.join(CACHE_PATH, key + ".json")
+    tmpPath = path + "." + str(os.getpid())
+    with open(tmpPath, "w") as cacheFile:
+        json.dump(list(params), cacheFile)
+    os.replace(tmpPath, path)
+
+
+# Imputes the missing values of every column of `items`, fitting all uncached columns together
+def impute_items(items, model=MODEL):
+    imputed = items.copy()
+    columns, keys, params = [], [], []
+    toFit = []
+
+    for col in items.columns:
+        series = items[col].to_numpy(dtype=float)
+        observed = series[~np.isnan(series)]
+        if len(observed) == len(series):
+            continue
+        if len(observed) < 3:
+            # na_kalman needs at least 3 non-NA values; leave the column for the missingness check
+            print("Not enough values to impute", col)
+            continue
+        if np.nanvar(series, ddof=1) == 0:
+            imputed[col] = observed[0]
+            continue
+
+        key = cache_key(series, model)
+        columns.append(col)
+        keys.append(key)
+        params.append(load_params(key))
+        if params[-1] is None:
+            toFit.append(len(columns) - 1)
+
+    if not columns:
+        return imputed, 0, 0
+
+    y = np.vstack([items[col].to_numpy(dtype=float) for col in columns])
+    if toFit:
+        fitted = fit_params(y[toFit], model)
+        for i, p in zip(toFit, fitted):
+            params[i] = p
+            save_params(keys[i], p)
+
+    level = kalman_smooth(y, np.vstack(params), model)
+    for i, col in enumerate(columns):
+        imputed[col] = np.where(np.isnan(y[i]), level[i], y[i])
+
+    return imputed, len(toFit), len(columns) - len(toFit)
+
+
+def impute_file(filePath):
+    dat = pd.read_csv(filePath, na_values=["", " ", "NA"], keep_default_na=False)
+    items = dat.columns[ITEM_START:]
+    numeric = [col for col in items if pd.api.types.is_numeric_dtype(dat[col])]
+
+    dat[numeric], nFitted, nCached = impute_items(dat[numeric].astype(float))
+
+    folder, name = os.path.split(filePath)
+    idName = name[:name.find("_rawwithtime")]
+    outPath = os.path.join(folder, idName + "_imputed_rawwithtime" + date.today().isoformat() + ".csv")
+    dat.to_csv(outPath, index=False, na_rep="NA")
+
+    missing = dat[numeric].isna().sum().sum()
+    return idName, outPath, nFitted, nCached, missing
+
+
+# Latest _rawwithtime file for every participant folder
+def find_inputs(dataPath=DATA_PATH):
+    latest = {}
+    for path in sorted(glob.glob(os.path.join(dataPath, "*", "*_rawwithtime*.csv"))):
+        name = os.path.basename(path)
+        if "_imputed_" in name:
+            continue
+        latest[name[:name.find("_rawwithtime")]] = path
+    return list(latest.values())
+
+
+if __name__ == "__main__":
+    inputs = find_inputs()
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for idName, outPath, nFitted, nCached, missing in pool.map(impute_file, inputs):
+            print(idName, "->", outPath, "fitted:", nFitted, "cached:", nCached, "still missing:", missing)
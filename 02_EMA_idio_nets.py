@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# graphicalVAR-style idiographic networks for every participant and dataset variant
+# (means/sd x raw/imputed), the same model as 02_EMA_idio_nets.Rmd: a temporal network
+# (PDC) from the lag-1 regression and a contemporaneous network (PCC) from the residual
+# precision matrix, with the penalties picked by EBIC over a lambda grid.
+# Reads Data/<ID>/<ID>_[imputed_]<means|sd><date>.csv and writes every PCC/PDC edge and
+# centrality value to one long table, Results/idio_networks<date>.csv.
+
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+DATA_PATH = "Data"
+RESULTS_PATH = "Results"
+ITEM_START = 9  # dat_means[,10:ncol(dat_means)] in the Rmd
+DETREND = True  # Regress each scaled item on cumsumT first, as for dedatm/dedatsd in the Rmd
+N_LAMBDA = 50  # graphicalVAR defaults for the grid and EBIC
+FULL_GRID = False  # Fit every lambda pair as graphicalVAR does, instead of alternating 1-D searches
+LAMBDA_MIN_RATIO = 0.05
+GAMMA = 0.5
+MAX_WORKERS = None
+
+VARIANTS = [(data, items) for data in ["raw", "imputed"] for items in ["means", "sd"]]
+
+
+def soft(x, t):
+    return np.sign(x) * np.maximum(np.abs(x) - t, 0.0)
+
+
+# Graphical lasso with a penalized diagonal, as graphicalVAR uses, solved by ADMM
+# (Boyd et al., 2011, sec. 6.5) so every step is a whole-matrix update.
+# `warm` is the (Z, U) pair of a previous solution on a nearby lambda.
+def glasso(S, rho, warm=None, mu=1.0, tol=1e-5, maxIter=1000):
+    p = S.shape[0]
+    if warm is None:
+        Z, U = np.eye(p), np.zeros((p, p))
+    else:
+        Z, U = warm
+
+    for _ in range(maxIter):
+        d, Q = np.linalg.eigh(mu * (Z - U) - S)
+        X = (Q * ((d + np.sqrt(d ** 2 + 4 * mu)) / (2 * mu))) @ Q.T
+        old = Z
+        Z = soft(X + U, rho / mu)
+        U = U + X - Z
+        if np.abs(X - Z).max() < tol and np.abs(Z - old).max() < tol:
+            break
+
+    return Z, (Z, U)
+
+
+# Rothman et al. (2010) alternating estimation of the lag-1 coefficients and the residual
+# precision matrix. Only the cross-products S = X'X/n, XY = X'Y/n and YY = Y'Y/n are used,
+# so every fit on the grid reuses the same precomputed design. Row 0 of `beta` is the
+# intercept and is not penalized.
+def rothman(design, lambdaBeta, lambdaKappa, warm, tol=1e-4, maxIter=100):
+    S, XY, YY = design
+    beta, kappa, glassoWarm = warm
+    penalty = np.full(beta.shape, lambdaBeta)
+    penalty[0] = 0
+    eigS = np.linalg.eigvalsh(S)[-1]
+
+    for _ in range(maxIter):
+        old = beta
+
+        # FISTA on tr((YY - 2 beta'XY + beta'S beta) kappa) + lambda |beta|, with steps of
+        # 1 / L for L the largest eigenvalue of the Hessian, 2 kappa (x) S
+        H = XY @ kappa
+        step = 1 / (2 * eigS * np.linalg.eigvalsh(kappa)[-1])
+        z, t = beta, 1.0
+        for _ in range(maxIter * 10):
+            previous = beta
+            beta = soft(z - step * 2 * (S @ z @ kappa - H), step * penalty)
+            tNext = (1 + np.sqrt(1 + 4 * t * t)) / 2
+            z = beta + (t - 1) / tNext * (beta - previous)
+            t = tNext
+            if np.abs(beta - previous).max() < tol / 10:
+                break
+
+        WS = YY - XY.T @ beta - beta.T @ XY + beta.T @ S @ beta
+        kappa, glassoWarm = glasso(WS, lambdaKappa, glassoWarm)
+
+        if np.abs(beta - old).max() < tol:
+            break
+
+    return beta, kappa, glassoWarm, WS
+
+
+# Lag-1 pairs within each day, the way graphicalVAR pairs beeps with dayvar/beepvar
+def lag_design(dat, items):
+    values = dat[items].to_numpy(dtype=float)
+    values = (values - np.nanmean(values, axis=0)) / np.nanstd(values, axis=0, ddof=1)
+
+    day = dat["dayvar"].to_numpy()
+    beep = dat["beepvar"].to_numpy()
+    rows = np.flatnonzero((day[1:] == day[:-1]) & (beep[1:] == beep[:-1] + 1)) + 1
+
+    Y = values[rows]
+    X = values[rows - 1]
+    keep = ~np.isnan(Y).any(axis=1) & ~np.isnan(X).any(axis=1)
+    Y, X = Y[keep], X[keep]
+    X = np.column_stack([np.ones(len(X)), X])
+
+    n = len(Y)
+    return (X.T @ X / n, X.T @ Y / n, Y.T @ Y / n), n
+
+
+def detrend(dat, items):
+    dat = dat.copy()
+    time = dat["cumsumT"].to_numpy(dtype=float)
+    for item in items:
+        x = dat[item].to_numpy(dtype=float)
+        x = (x - np.nanmean(x)) / np.nanstd(x, ddof=1)
+        ok = ~np.isnan(x)
+        slope, intercept = np.polyfit(time[ok], x[ok], 1)
+        dat[item] = x - (intercept + slope * time)
+    return dat
+
+
+def fit_network(dat, items):
+    design, n = lag_design(dat, items)
+    S, XY, YY = design
+    p = len(items)
+
+    corY = YY / np.sqrt(np.outer(np.diag(YY), np.diag(YY)))
+    kappaMax = np.abs(corY[np.triu_indices(p, 1)]).max()
+    betaMax = 2 * np.abs(XY[1:] @ np.linalg.pinv(YY)).max()
+    lambdaKappa = np.exp(np.linspace(np.log(kappaMax), np.log(kappaMax * LAMBDA_MIN_RATIO), N_LAMBDA))
+    lambdaBeta = np.exp(np.linspace(np.log(betaMax), np.log(betaMax * LAMBDA_MIN_RATIO), N_LAMBDA))
+
+    fits = {}
+
+    def fit(i, k, warm):
+        if (i, k) not in fits:
+            beta, kappa, glassoWarm, WS = rothman(design, lambdaBeta[i], lambdaKappa[k], warm)
+            logLik = np.linalg.slogdet(kappa)[1] - np.trace(WS @ kappa)
+            edges = (np.abs(beta[1:]) > 1e-4).sum() + (np.abs(kappa[np.triu_indices(p, 1)]) > 1e-4).sum()
+            ebic = -n * logLik + edges * np.log(n) + edges * 4 * GAMMA * np.log(2 * p)
+            fits[(i, k)] = (ebic, (beta, kappa, glassoWarm))
+        return fits[(i, k)][1]
+
+    start = (np.zeros((p + 1, p)), np.eye(p), None)
+    if FULL_GRID:
+        # Warm starts: along lambda_beta within a row, and from the first fit of the previous row
+        for k in range(N_LAMBDA):
+            warm = start
+            for i in range(N_LAMBDA):
+                warm = fit(i, k, warm)
+                if i == 0:
+                    start = warm
+    else:
+        # Starting from the sparsest lambda_beta, search lambda_kappa, then lambda_beta at the
+        # best lambda_kappa, and so on until the best pair stops changing. Each line is warm
+        # started from the current best fit.
+        best, searchKappa = (0, 0), True
+        while True:
+            warm = fit(*best, start)
+            for j in range(N_LAMBDA):
+                warm = fit(best[0], j, warm) if searchKappa else fit(j, best[1], warm)
+            newBest = min(fits, key=lambda pair: fits[pair][0])
+            if newBest == best and not searchKappa:
+                break
+            best, searchKappa = newBest, not searchKappa
+
+    i, k = min(fits, key=lambda pair: fits[pair][0])
+    beta, kappa, _ = fits[(i, k)][1]
+    lb, lk = lambdaBeta[i], lambdaKappa[k]
+    sigma = np.linalg.inv(kappa)
+    d = np.sqrt(np.diag(kappa))
+    pcc = -kappa / np.outer(d, d)
+    np.fill_diagonal(pcc, 0)
+    # PDC[from, to], the transpose of graphicalVAR's beta orientation
+    pdc = beta[1:] / np.sqrt(np.outer(np.diag(kappa), np.diag(sigma)) + beta[1:] ** 2)
+    return pcc, pdc, lb, lk, n
+
+
+def centrality(pcc, pdc, items):
+    # qgraph leaves self-loops out of strength, so the autoregressive PDC diagonal doesn't count
+    pdc = pdc.copy()
+    np.fill_diagonal(pdc, 0)
+    table = pd.DataFrame({
+        "node": items * 3,
+        "measure": ["Strength"] * len(items) + ["OutStrength"] * len(items) + ["InStrength"] * len(items),
+        "raw": np.concatenate([np.abs(pcc).sum(axis=1), np.abs(pdc).sum(axis=1), np.abs(pdc).sum(axis=0)]),
+    })
+    # qgraph's centralityTable reports z-scores by default
+    table["value"] = table.groupby("measure")["raw"].transform(lambda v: (v - v.mean()) / v.std())
+    return table
+
+
+def estimate(job):
+    idName, data, items, filePath = job
+    dat = pd.read_csv(filePath, na_values=["", " ", "NA"], keep_default_na=False)
+    nodes = list(dat.columns[ITEM_START:])
+    # A constant item has no variance to standardize or regress on
+    constant = [item for item in nodes if dat[item].nunique() < 2]
+    if constant:
+        print(idName, data, items, "dropped constant items:", ", ".join(constant))
+        nodes = [item for item in nodes if item not in constant]
+    if len(nodes) < 2:
+        raise ValueError("fewer than 2 non-constant items")
+    if DETREND:
+        dat = detrend(dat, nodes)
+
+    pcc, pdc, lb, lk, n = fit_network(dat, nodes)
+
+    results = []
+    for network, mat in [("PCC", pcc), ("PDC", pdc)]:
+        frm, to = np.meshgrid(nodes, nodes, indexing="ij")
+        edges = pd.DataFrame({"type": network, "node": frm.ravel(), "to": to.ravel(), "measure": "weight", "value": mat.ravel()})
+        results.append(edges[edges["node"] != edges["to"]] if network == "PCC" else edges)
+    cent = centrality(pcc, pdc, nodes)
+    cent.insert(0, "type", "centrality")
+    results.append(cent)
+
+    results = pd.concat(results, ignore_index=True)
+    results.insert(0, "ID", idName)
+    results.insert(1, "data", data)
+    results.insert(2, "items", items)
+    results["lambda_beta"] = lb
+    results["lambda_kappa"] = lk
+    results["n"] = n
+    return results
+
+
+# Latest file of each participant and dataset variant
+def find_jobs(dataPath=DATA_PATH):
+    jobs = []
+    for folder in sorted(glob.glob(os.path.join(dataPath, "*", ""))):
+        idName = os.path.basename(os.path.dirname(folder))
+        for data, items in VARIANTS:
+            prefix = idName + ("_imputed_" if data == "imputed" else "_") + items
+            pattern = re.compile(re.escape(prefix) + r"\d{4}-\d{2}-\d{2}\.csv$")
+            matches = sorted(f for f in os.listdir(folder) if pattern.match(f))
+            if matches:
+                jobs.append((idName, data, items, os.path.join(folder, matches[-1])))
+    return jobs
+
+
+if __name__ == "__main__":
+    jobs = find_jobs()
+    results = []
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = [pool.submit(estimate, job) for job in jobs]
+        # A failed fit skips that participant and variant instead of the whole run
+        for (idName, data, items, filePath), future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as error:
+                print("Skipped", idName, data, items, "(" + filePath + "):", repr(error))
+
+    if not results:
+        raise SystemExit("No networks estimated")
+    results = pd.concat(results, ignore_index=True)
+
+    os.makedirs(RESULTS_PATH, exist_ok=True)
+    outPath = os.path.join(RESULTS_PATH, "idio_networks" + date.today().isoformat() + ".csv")
+    results.to_csv(outPath, index=False)
+    print("Estimated", results.groupby(["ID", "data", "items"]).ngroups, "of", len(jobs), "networks into:", outPath)
@@ -1,11 +1,43 @@
+import asyncio
 import csv  
 import datetime  
+import gzip
+import heapq
+import io
 import os 
 import math  
+import queue
+import re
+import threading
+import time
+import zipfile
 
 DESIRED_FREQUENCY = 4  
 # A value of 4 is 4Hz, so the period is 1/4 of a second or 0.25s
 
+# Parse feature files and write output on their own threads while merging. The threads share
+# the GIL, so this only pays off when reads wait on slow storage such as a network mount; on
+# local disk the sequential merge is faster. Output is the same either way.
+PIPELINED = False
+READ_BATCH = 512  # Periods per batch handed from a reader thread to the merge
+QUEUE_BATCHES = 8  # Batches a reader or the writer may hold before it has to wait
+WRITE_BATCH = 1024  # Rows per batch handed from the merge to the writer thread
+MAX_OPEN_FILES = 16  # Cap on files held open at once, inputs and outputs alike. A batch merge holds its
+                     # inputs plus 2 + PYRAMID_OPEN_FILES, a live participant 1 + PYRAMID_OPEN_FILES
+OPEN_FILE_TIMEOUT = 30.0  # Seconds to wait for a free file slot before giving up with OSError
+SORTED_FOLDER = "sorted"  # Subfolder for the time-sorted copies, so the originals are never rewritten
+
+PYRAMID_LEVELS = [("1s", 1), ("1min", 60), ("15min", 900), ("1h", 3600)]  # Summary bin widths in seconds
+PYRAMID_MIN_POINTS = 200  # readPyramid uses the coarsest level with at least this many bins in the span
+PYRAMID_OPEN_FILES = 2  # The finest level stays open; coarser levels share one slot and reopen to append each bin
+
+LIVE = False  # Serve live feature streams instead of merging the files in the folder
+LIVE_HOST = "127.0.0.1"
+LIVE_PORT = 8765
+ALLOWED_LATENESS = 2.0  # Seconds of sample time a row waits behind the slowest stream for out-of-order samples
+LIVE_STALL_TIMEOUT = 5.0  # Seconds of silence after which a stream no longer holds back the merge
+LIVE_QUEUE_SIZE = 10000  # Rows a subscriber queue holds before its oldest rows are dropped
+
 class FeatureType:  
     def __init__(self, name, timeIndex, headers, frequency, mergeOrder) -> None:
         self.name = name
@@ -26,28 +58,72 @@ FEATURES = [  # phys feature types
 
 FEATURENAMES = list(map(lambda i: i.name, FEATURES)) 
 
-def sortByTime(filePath):  
-    readObj = open(filePath, "r")
-    csvReader = csv.reader(readObj)
+LIVE_FEATURES = FEATURENAMES  # Feature streams every live participant is expected to send
 
-    header = next(csvReader)
+PYRAMID_COLUMNS = [header for feature in FEATURES for header in feature.headers if header not in ["event", "code"]]  # Merged columns that get summarized
 
-    rows = []
-    for row in csvReader:
-        rows.append(row)
+# Participant name, then the feature name, at the start of a file name
+FILEPATTERN = re.compile("(.*?)(" + "|".join(map(re.escape, FEATURENAMES)) + ")")
+
+openFileSlots = threading.BoundedSemaphore(MAX_OPEN_FILES)
+
+# Takes `count` of the MAX_OPEN_FILES slots, or raises OSError if they don't free up in time
+def acquireFileSlots(count=1, timeout=OPEN_FILE_TIMEOUT):
+    for taken in range(count):
+        if not openFileSlots.acquire(timeout=timeout):
+            releaseFileSlots(taken)
+            raise OSError("No free file slot after " + str(timeout) + "s, MAX_OPEN_FILES is " + str(MAX_OPEN_FILES))
+
+def releaseFileSlots(count=1):
+    for _ in range(count):
+        openFileSlots.release()
+
+# A source is a CSV path, a gzip-compressed CSV path (.gz), or a (zip path, member name)
+# pair; compressed sources are decompressed while they are read, never extracted to disk
+def openSource(source):
+    if isinstance(source, tuple):
+        with zipfile.ZipFile(source[0]) as archive:
+            # The member keeps the archive's file open until the member itself is closed
+            return io.TextIOWrapper(archive.open(source[1]), newline="")
+    if source.endswith(".gz"):
+        return gzip.open(source, "rt", newline="")
+    return open(source, "r")
 
-    readObj.close()  
+def sortByTime(source, sortedPath):  
+    # The source is closed before the sorted copy is opened, so one slot covers both
+    acquireFileSlots()
+    try:
+        readObj = openSource(source)
+        csvReader = csv.reader(readObj)
 
-    index = header.index("timestamp")
-    rows = sorted(rows, key=lambda i: datetime.datetime.fromisoformat(i[index]))
+        header = next(csvReader)
 
-    writeObj = open(filePath, "w", newline="")
-    csvWriter = csv.writer(writeObj)
+        rows = []
+        for row in csvReader:
+            rows.append(row)
 
-    csvWriter.writerow(header)
-    csvWriter.writerows(rows)
+        readObj.close()  
 
-    writeObj.close()  
+        index = header.index("timestamp")
+        rows = sorted(rows, key=lambda i: datetime.datetime.fromisoformat(i[index]))
+
+        # Written under a temporary name, so an interrupted sort never leaves a copy that looks current
+        tmpPath = sortedPath + ".tmp"
+        if sortedPath.endswith(".gz"):
+            writeObj = gzip.open(tmpPath, "wt", newline="", compresslevel=1)
+        else:
+            writeObj = open(tmpPath, "w", newline="")
+        csvWriter = csv.writer(writeObj)
+
+        csvWriter.writerow(header)
+        csvWriter.writerows(rows)
+
+        writeObj.close()
+        os.replace(tmpPath, sortedPath)
+    finally:
+        releaseFileSlots()
+
+    return sortedPath
 
 def getTime(timeString) -> datetime:
     return datetime.datetime.fromisoformat(timeString)
@@ -80,7 +156,12 @@ class fileProcessor:
             return TypeError
 
     def _openfile(self):
-        self._readObj = open(self._filePath, "r")
+        acquireFileSlots()
+        try:
+            self._readObj = openSource(self._filePath)
+        except:
+            releaseFileSlots()
+            raise
         self._reader = csv.reader(self._readObj)
 
     def _setLength(self):
@@ -121,103 +202,668 @@ class fileProcessor:
         return self.lastLine
     
     def __del__(self):
-        self._readObj.close()  
+        if hasattr(self, "_readObj"):
+            self.closeFile()
 
     def closeFile(self):
-        self._readObj.close() 
-
-def MergeFiles(files, newFilePath):
-    global DEBUG
-
-    mergeFile = open(newFilePath + "MERGED.csv", "w", newline="")
-    debugFile = open(newFilePath + "DEBUG.csv", "w", newline="")
-
-    mergeWriter = csv.writer(mergeFile)
-    debugWriter = csv.writer(debugFile)
+        if not self._readObj.closed:
+            self._readObj.close()
+            releaseFileSlots()
+
+class pipelinedFile:
+    # Same interface as fileProcessor, but a reader thread parses the periods ahead
+    # into a bounded queue, so the merge doesn't wait on each read
+    def __init__(self, file) -> None:
+        self.feature = file.feature
+        self.headers = file.headers
+        self.currentLine = file.currentLine
+        self.lastLine = None
+        self._file = file
+        self._queue = queue.Queue(maxsize=QUEUE_BATCHES)
+        self._batch = []
+        self._next = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        batch = []
+        try:
+            while not self._stopped.is_set():
+                line = self._file.nextPeriod()
+                batch.append((line, self._file.currentLine))
+                if line is None:
+                    break
+                if len(batch) >= READ_BATCH:
+                    self._queue.put(batch)
+                    batch = []
+            self._queue.put(batch)
+        except Exception as error:
+            self._queue.put(error)
+
+    def nextPeriod(self):
+        if self._next >= len(self._batch):
+            if self.lastLine is None and self._batch:
+                return None
+            self._batch = self._queue.get()
+            self._next = 0
+            if isinstance(self._batch, Exception):
+                raise self._batch
+
+        self.lastLine, self.currentLine = self._batch[self._next]
+        self._next += 1
+        return self.lastLine
 
-    mergedHeader = ["timer", "timestamp"]
+    # Stops the reader thread, which may be waiting on a full queue if the merge failed
+    def closeFile(self):
+        self._stopped.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self._file.closeFile()
+
+class rowWriter:
+    # Writes rows for a csv writer on a shared writer thread, in batches
+    def __init__(self, csvWriter, writerThread) -> None:
+        self._csvWriter = csvWriter
+        self._writer = writerThread
+        self._rows = []
+
+    def writerow(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= WRITE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._writer.put((self._csvWriter, self._rows))
+            self._rows = []
+
+class rowWriterThread:
+    # Writes the batches of every rowWriter on one thread. A write error is kept and
+    # raised on the merge thread by the next put or by join; until then the thread
+    # keeps draining the queue so the merge never blocks on a dead writer
+    def __init__(self) -> None:
+        self._queue = queue.Queue(maxsize=QUEUE_BATCHES)
+        self._error = None
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue
+            csvWriter, rows = item
+            try:
+                csvWriter.writerows(rows)
+            except Exception as error:
+                self._error = error
+
+    def _raise(self):
+        if self._error is not None:
+            raise self._error
+
+    def put(self, item):
+        self._raise()
+        self._queue.put(item)
+
+    # Waits for the queued batches to be written; safe to call more than once
+    def stop(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def join(self):
+        self.stop()
+        self._raise()
+
+class summaryBin:
+    # Count, mean, min, max and sum of squared deviations of each column over one time bin
+    def __init__(self, start, width) -> None:
+        self.start = start
+        self.count = 0
+        self.mean = [0.0] * width
+        self.m2 = [0.0] * width
+        self.min = [math.inf] * width
+        self.max = [-math.inf] * width
+
+    # Adds another set of statistics (a single row is a bin of count 1), with Chan et al.'s pairwise update
+    def combine(self, count, mean, m2, minimum, maximum):
+        total = self.count + count
+        for i in range(len(self.mean)):
+            delta = mean[i] - self.mean[i]
+            self.mean[i] += delta * count / total
+            self.m2[i] += m2[i] + delta * delta * self.count * count / total
+            self.min[i] = min(self.min[i], minimum[i])
+            self.max[i] = max(self.max[i], maximum[i])
+        self.count = total
+
+    def row(self):
+        std = [math.sqrt(m2 / (self.count - 1)) if self.count > 1 else "" for m2 in self.m2]
+        return [self.start, self.count] + [value for stats in zip(self.mean, self.min, self.max, std) for value in stats]
+
+class summaryPyramid:
+    # Downsampled summaries of merged rows, one CSV per PYRAMID_LEVELS entry next to the merged
+    # output. Each level is built from the closed bins of the level below it, and bins are
+    # written as they close, so the files grow with the merge. With append=True a bin can be
+    # written more than once across runs; readPyramid combines those rows. Only the finest
+    # level is held open; the coarser levels close a bin rarely, so each of their rows is
+    # appended by reopening the file, and the pyramid holds PYRAMID_OPEN_FILES slots in all.
+    def __init__(self, filePrefix, mergedHeader, append=False, timeout=OPEN_FILE_TIMEOUT) -> None:
+        self.columns = [name for name in mergedHeader if name in PYRAMID_COLUMNS]
+        self._indexes = [mergedHeader.index(name) for name in self.columns]
+        header = ["timestamp", "count"] + [name + "_" + stat for name in self.columns for stat in ["mean", "min", "max", "std"]]
+
+        self._paths = [filePrefix + "PYRAMID_" + levelName + ".csv" for levelName, seconds in PYRAMID_LEVELS]
+        self._bins = [None] * len(PYRAMID_LEVELS)
+        self._filePrefix = filePrefix
+        self._file = None
+        self.skippedRows = 0
+        acquireFileSlots(PYRAMID_OPEN_FILES, timeout)
+        try:
+            for path in reversed(self._paths):
+                newFile = not append or not os.path.exists(path)
+                levelFile = open(path, "a" if append else "w", newline="")
+                if newFile:
+                    csv.writer(levelFile).writerow(header)
+                if path == self._paths[0]:
+                    self._file = levelFile
+                    self._writer = csv.writer(levelFile)
+                else:
+                    levelFile.close()
+        except:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            releaseFileSlots(PYRAMID_OPEN_FILES)
+            raise
+
+    # A row with a blank, non-numeric or non-finite value is left out of the summaries only;
+    # it is still merged, and close reports how many were skipped
+    def add(self, timestamp, line):
+        try:
+            values = [float(line[i]) for i in self._indexes]
+        except ValueError:
+            values = None
+        if values is None or not all(map(math.isfinite, values)):
+            self.skippedRows += 1
+            return
+        self._add(0, timestamp, 1, values, [0.0] * len(values), values, values)
+
+    def _add(self, level, timestamp, count, mean, m2, minimum, maximum):
+        # Floored on the naive wall-clock time, so bins stay on the hour in any timezone and across DST
+        seconds = PYRAMID_LEVELS[level][1]
+        midnight = timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        start = midnight + datetime.timedelta(seconds=math.floor((timestamp - midnight).total_seconds() / seconds) * seconds)
+        current = self._bins[level]
+        if current is not None and current.start != start:
+            self._close(level)
+            current = None
+        if current is None:
+            current = self._bins[level] = summaryBin(start, len(mean))
+        current.combine(count, mean, m2, minimum, maximum)
+
+    def _close(self, level):
+        current = self._bins[level]
+        if level == 0:
+            self._writer.writerow(current.row())
+        else:
+            with open(self._paths[level], "a", newline="") as levelFile:
+                csv.writer(levelFile).writerow(current.row())
+        self._bins[level] = None
+        if level + 1 < len(PYRAMID_LEVELS):
+            self._add(level + 1, current.start, current.count, current.mean, current.m2, current.min, current.max)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        for level in range(len(PYRAMID_LEVELS)):
+            if self._bins[level] is not None:
+                self._close(level)
+        self._file.close()
+        self._file = None
+        releaseFileSlots(PYRAMID_OPEN_FILES)
+        if self.skippedRows:
+            print("Summary pyramid", self._filePrefix + "PYRAMID_*:", self.skippedRows, "rows with non-numeric values left out")
+
+# Reads the summaries between start and end from the coarsest level that still gives at least
+# minPoints bins over that span. Returns the level name and one dict per bin, oldest first
+def readPyramid(filePrefix, start, end, minPoints=PYRAMID_MIN_POINTS):
+    span = (end - start).total_seconds()
+    levels = [level for level in PYRAMID_LEVELS if span / level[1] >= minPoints] or PYRAMID_LEVELS[:1]
+    levelName, seconds = levels[-1]
+
+    bins = {}
+    readObj = open(filePrefix + "PYRAMID_" + levelName + ".csv", "r")
+    csvReader = csv.reader(readObj)
+    header = next(csvReader)
+    columns = [name[:-len("_mean")] for name in header if name.endswith("_mean")]
 
-    for file in files:
-        for header in file.headers:
-            mergedHeader.append(header)
-            
-    mergeWriter.writerow(mergedHeader)  
-    debugHeader = mergedHeader.copy()  
+    for line in csvReader:
+        binTime = getTime(line[0])
+        if binTime + datetime.timedelta(seconds=seconds) <= start or binTime >= end:
+            continue
 
-    for feature in sorted(FEATURES, key=lambda i: i.mergeOrder):
-        debugHeader.append(feature.name + " line #")
+        count = int(line[1])
+        stats = [line[2 + 4 * i:6 + 4 * i] for i in range(len(columns))]
+        mean = [float(s[0]) for s in stats]
+        m2 = [float(s[3]) ** 2 * (count - 1) if s[3] != "" else 0.0 for s in stats]
+        if binTime not in bins:
+            bins[binTime] = summaryBin(binTime, len(columns))
+        bins[binTime].combine(count, mean, m2, [float(s[1]) for s in stats], [float(s[2]) for s in stats])
+    readObj.close()
+
+    result = []
+    for binTime in sorted(bins):
+        row = bins[binTime].row()
+        result.append(dict(zip(["timestamp", "count"] + [name + "_" + stat for name in columns for stat in ["mean", "min", "max", "std"]], row)))
+    return levelName, result
+
+def MergeFiles(files, newFilePath, pipelined=PIPELINED):
+    global DEBUG
 
-    debugWriter.writerow(debugHeader)  
+    acquireFileSlots(2)  # MERGED and DEBUG
+    mergeFile = None
+    debugFile = None
+    openFiles = []
+    writerThread = None
+    pyramid = None
+    try:
+        mergeFile = open(newFilePath + "MERGED.csv", "w", newline="")
+        debugFile = open(newFilePath + "DEBUG.csv", "w", newline="")
+
+        mergeWriter = csv.writer(mergeFile)
+        debugWriter = csv.writer(debugFile)
+
+        if pipelined:
+            for file in files:
+                openFiles.append(pipelinedFile(file))
+            files = list(openFiles)
+            writerThread = rowWriterThread()
+            mergeWriter = rowWriter(mergeWriter, writerThread)
+            debugWriter = rowWriter(debugWriter, writerThread)
+
+        mergedHeader = ["timer", "timestamp"]
+
+        for file in files:
+            for header in file.headers:
+                mergedHeader.append(header)
+                
+        mergeWriter.writerow(mergedHeader)  
+        pyramid = summaryPyramid(newFilePath, mergedHeader)
+        debugHeader = mergedHeader.copy()  
 
-    [curFile.nextPeriod() for curFile in files]  
-    lineCount = 1  
-    timer = 0  
-    previousTimestamp = None  
+        for feature in sorted(FEATURES, key=lambda i: i.mergeOrder):
+            debugHeader.append(feature.name + " line #")
 
-    while len(files) > 0:
-        currentTimestamp = sorted(files, key=lambda i: i.lastLine.time)[0].lastLine.time
+        debugWriter.writerow(debugHeader)  
 
-        if previousTimestamp is not None and (currentTimestamp - previousTimestamp).total_seconds() > 0.25:
-            timer = 0
-        else:
-            timer += 0.25
-        
-        currentLine = [timer, currentTimestamp]
+        [curFile.nextPeriod() for curFile in files]  
+        lineCount = 1  
+        timer = 0  
+        previousTimestamp = None  
 
-        lineNumbers = []
+        while len(files) > 0:
+            currentTimestamp = sorted(files, key=lambda i: i.lastLine.time)[0].lastLine.time
 
-        for curFile in files:
-            if (curFile.lastLine.time - currentTimestamp).total_seconds() < curFile.feature.period:
-                for data in curFile.lastLine.data:
-                    currentLine.append(data)
-                
-                lineNumbers.append(curFile.currentLine)
-                
-                if curFile.lastLine.time == currentTimestamp:
-                    curFile.nextPeriod()
+            if previousTimestamp is not None and (currentTimestamp - previousTimestamp).total_seconds() > 0.25:
+                timer = 0
             else:
-                for data in curFile.lastLine.data:
-                    currentLine.append("-")
-
-        debugLine = currentLine.copy() + lineNumbers
-                
-        previousTimestamp = currentTimestamp
-
-        files = list(filter(lambda i: i.lastLine is not None, files))
+                timer += 0.25
+            
+            currentLine = [timer, currentTimestamp]
+
+            lineNumbers = []
+
+            for curFile in files:
+                if (curFile.lastLine.time - currentTimestamp).total_seconds() < curFile.feature.period:
+                    for data in curFile.lastLine.data:
+                        currentLine.append(data)
+                    
+                    lineNumbers.append(curFile.currentLine)
+                    
+                    if curFile.lastLine.time == currentTimestamp:
+                        curFile.nextPeriod()
+                else:
+                    for data in curFile.lastLine.data:
+                        currentLine.append("-")
+
+            debugLine = currentLine.copy() + lineNumbers
+                    
+            previousTimestamp = currentTimestamp
+
+            files = list(filter(lambda i: i.lastLine is not None, files))
+
+            if "-" in currentLine or len(currentLine) != len(mergedHeader):
+                timer -= 0.25
+                continue
+            
+            mergeWriter.writerow(currentLine)
+            debugWriter.writerow(debugLine)
+            pyramid.add(currentTimestamp, currentLine)
+
+            lineCount += 1
+
+        if pipelined:
+            mergeWriter.flush()
+            debugWriter.flush()
+            writerThread.join()
+
+        print("\nMerged all files into:", newFilePath, "lines:", lineCount)
+    finally:
+        # Reader and writer threads are stopped and every file closed even when the merge fails
+        if writerThread is not None:
+            writerThread.stop()
+        [curFile.closeFile() for curFile in openFiles]
+        [outFile.close() for outFile in [mergeFile, debugFile] if outFile is not None]
+        releaseFileSlots(2)
+        if pyramid is not None:
+            pyramid.close()
+
+class liveStream:
+    # Buffered samples of one feature stream, ordered by time
+    def __init__(self, feature) -> None:
+        self.feature = feature
+        self.samples = []
+        self.latest = None
+        self.lastArrival = time.monotonic()
+        self.connections = 0  # Open connections sending this stream; a dropped stream may reconnect
+        self.ended = False
+
+class liveMerger:
+    # Merges a participant's live feature streams onto the DESIRED_FREQUENCY grid with the same
+    # rules as MergeFiles. A timestamp is merged once every stream has a sample buffered, or once
+    # the watermark has passed it: the oldest latest sample among the streams still sending, minus
+    # ALLOWED_LATENESS. A stream silent for LIVE_STALL_TIMEOUT seconds stops holding the others
+    # back; rows it has no sample for are incomplete and dropped as in MergeFiles. Samples older
+    # than the last merged timestamp are late and dropped.
+    def __init__(self, newFilePath) -> None:
+        self.features = sorted([feature for feature in FEATURES if feature.name in LIVE_FEATURES], key=lambda i: i.mergeOrder)
+        self.header = ["timer", "timestamp"] + [header for feature in self.features for header in feature.headers]
+        self.streams = {feature.name: liveStream(feature) for feature in self.features}
+        self.subscribers = []
+        self.lateSamples = 0
+        self.lineCount = 1
+        self._previousTimestamp = None
+        self._timer = 0
+        self._order = 0
+        self.closed = False
+
+        # Slots are taken without waiting, which would block the event loop; a participant
+        # over MAX_OPEN_FILES is rejected with OSError instead
+        acquireFileSlots(1, timeout=0)
+        try:
+            newFile = not os.path.exists(newFilePath + "LIVE_MERGED.csv")
+            self._mergeFile = open(newFilePath + "LIVE_MERGED.csv", "a", newline="")
+            self._mergeWriter = csv.writer(self._mergeFile)
+            if newFile:
+                self._mergeWriter.writerow(self.header)
+            self._pyramid = summaryPyramid(newFilePath + "LIVE_", self.header, append=True, timeout=0)
+        except:
+            if hasattr(self, "_mergeFile"):
+                self._mergeFile.close()
+            releaseFileSlots()
+            raise
+
+    def subscribe(self):
+        subscriber = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def openStream(self, featureName):
+        if self.closed:
+            raise ValueError("Live merger is already closed")
+        if featureName not in self.streams:
+            raise ValueError("Unknown live feature: " + featureName)
+        stream = self.streams[featureName]
+        stream.connections += 1
+        stream.ended = False
+        stream.lastArrival = time.monotonic()
+
+    def addSample(self, featureName, sampleTime, data):
+        if self.closed:
+            raise ValueError("Live merger is already closed")
+        stream = self.streams[featureName]
+        stream.lastArrival = time.monotonic()
+
+        if sampleTime != findNearestPeriod(sampleTime):
+            return
+        if self._previousTimestamp is not None and sampleTime <= self._previousTimestamp:
+            self.lateSamples += 1
+            return
+
+        self._order += 1
+        heapq.heappush(stream.samples, (sampleTime, self._order, data))
+        if stream.latest is None or sampleTime > stream.latest:
+            stream.latest = sampleTime
+        self._merge()
+
+    # A stream has ended once its last open connection closes
+    def endStream(self, featureName):
+        stream = self.streams[featureName]
+        stream.connections -= 1
+        stream.ended = stream.connections == 0
+        self._merge()
+
+    def allEnded(self):
+        return all(stream.ended for stream in self.streams.values())
+
+    def _watermark(self):
+        now = time.monotonic()
+        latest = []
+        for stream in self.streams.values():
+            if stream.ended or now - stream.lastArrival > LIVE_STALL_TIMEOUT:
+                continue
+            if stream.latest is None:
+                return None
+            latest.append(stream.latest)
+        if not latest:
+            return None
+        return min(latest) - datetime.timedelta(seconds=ALLOWED_LATENESS)
+
+    def close(self):
+        # Merges whatever is still buffered, as at the end of the input files
+        self._merge(final=True)
+        self.closed = True
+        self._mergeFile.close()
+        releaseFileSlots()
+        self._pyramid.close()
+
+    def _merge(self, final=False):
+        watermark = self._watermark()
+
+        while True:
+            heads = [stream.samples[0][0] for stream in self.streams.values() if stream.samples]
+            if not heads:
+                break
+            currentTimestamp = min(heads)
+
+            ready = all(stream.samples or stream.ended for stream in self.streams.values())
+            if not (ready or final or (watermark is not None and currentTimestamp <= watermark)):
+                break
+
+            if self._previousTimestamp is not None and (currentTimestamp - self._previousTimestamp).total_seconds() > 0.25:
+                self._timer = 0
+            else:
+                self._timer += 0.25
+
+            currentLine = [self._timer, currentTimestamp]
+            for feature in self.features:
+                stream = self.streams[feature.name]
+                if stream.samples and (stream.samples[0][0] - currentTimestamp).total_seconds() < feature.period:
+                    currentLine += stream.samples[0][2]
+                    if stream.samples[0][0] == currentTimestamp:
+                        heapq.heappop(stream.samples)
+                else:
+                    currentLine += ["-"] * len(feature.headers)
+
+            self._previousTimestamp = currentTimestamp
+
+            if "-" in currentLine:
+                self._timer -= 0.25
+                continue
 
-        if "-" in currentLine or len(currentLine) != len(mergedHeader):
-            timer -= 0.25
-            continue
-        
-        mergeWriter.writerow(currentLine)
-        debugWriter.writerow(debugLine)
+            self._mergeWriter.writerow(currentLine)
+            self._pyramid.add(currentTimestamp, currentLine)
+            self.lineCount += 1
+            for subscriber in self.subscribers:
+                if subscriber.full():
+                    subscriber.get_nowait()  # Slow subscribers lose their oldest rows
+                subscriber.put_nowait(currentLine)
+
+        self._mergeFile.flush()
+        self._pyramid.flush()
+
+# Line protocol: the first line is "participant,feature", every following line is
+# "timestamp,value,..." with the values in that feature's FeatureType.headers order
+async def handleLiveStream(reader, writer, mergers, folderPath):
+    try:
+        participant, featureName = (await reader.readline()).decode().strip().split(",")
+        if participant not in mergers:
+            mergers[participant] = liveMerger(folderPath + participant)
+        merger = mergers[participant]
+        merger.openStream(featureName)
+    except Exception as error:
+        print("Rejected live stream:", error)
+        writer.close()
+        return
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            row = next(csv.reader([line.decode()]))
+            merger.addSample(featureName, getTime(row[0]), row[1:])
+    finally:
+        try:
+            if not merger.closed:
+                merger.endStream(featureName)
+                # The merger closes once every expected feature stream has ended
+                if merger.allEnded():
+                    merger.close()
+                    del mergers[participant]
+        finally:
+            writer.close()
+
+async def serveLive(folderPath, host=LIVE_HOST, port=LIVE_PORT):
+    mergers = {}
+    server = await asyncio.start_server(lambda reader, writer: handleLiveStream(reader, writer, mergers, folderPath), host, port)
+    print("Live merge listening on", host + ":" + str(port))
+    async with server:
+        await server.serve_forever()
+
+# Replays a feature file as a live stream, paced so that its timestamps pass speed times
+# faster than real time (speed=None sends as fast as possible); the file must be sorted by time
+async def replayFile(source, participant, featureName, host=LIVE_HOST, port=LIVE_PORT, speed=None):
+    feature = FEATURES[FEATURENAMES.index(featureName)]
+    loop = asyncio.get_running_loop()
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write((participant + "," + featureName + "\n").encode())
+
+    readObj = openSource(source)
+    csvReader = csv.reader(readObj)
+    header = next(csvReader)
+    dataIndexes = [header.index(name) for name in feature.headers if name in header]
 
-        lineCount += 1
+    startTime = None
+    startClock = loop.time()
+    for row in csvReader:
+        sampleTime = getTime(row[feature.timeIndex])
+        if speed is not None:
+            # Scheduled against the start, so the stream doesn't drift behind the others
+            startTime = startTime or sampleTime
+            delay = startClock + (sampleTime - startTime).total_seconds() / speed - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        out = io.StringIO()
+        csv.writer(out).writerow([row[feature.timeIndex]] + [row[i] for i in dataIndexes])
+        writer.write(out.getvalue().encode())
+        await writer.drain()
+
+    readObj.close()
+    writer.close()
+    await writer.wait_closed()
+
+async def replayParticipant(participant, plan, host=LIVE_HOST, port=LIVE_PORT, speed=None):
+    await asyncio.gather(*[replayFile(source, participant, featureName, host, port, speed) for featureName, name, source in plan])
+
+def addSource(plan, name, source):
+    match = FILEPATTERN.match(name)
+    if match is not None:
+        mergedName, featureName = match.groups()
+        plan.setdefault(mergedName, []).append((featureName, name, source))
+
+# Maps each participant to its (feature name, file name, source) entries without opening
+# any feature file. Members of a zip export are named after the archive when their own
+# names have no participant prefix (e.g. "P01.zip" holding "EDA.csv" is "P01_EDA.csv")
+def planParticipants(folderPath):
+    plan = {}
+    for name in sorted(os.listdir(folderPath)):
+        if name.endswith(".zip"):
+            with zipfile.ZipFile(folderPath + name) as archive:
+                members = [member for member in archive.namelist() if member.endswith(".csv")]
+
+            for member in members:
+                memberName = os.path.basename(member)
+                match = FILEPATTERN.match(memberName)
+                if match is not None and match.group(1) == "":
+                    memberName = name[:-len(".zip")] + "_" + memberName
+                addSource(plan, memberName, (folderPath + name, member))
+        elif name.endswith(".gz"):
+            addSource(plan, name[:-len(".gz")], folderPath + name)
+        else:
+            addSource(plan, name, folderPath + name)
+    return plan
+
+# Sorts and opens a participant's files only when its merge starts, and always closes them
+def mergeParticipant(participant, plan, folderPath):
+    # Every input stays open through the merge, next to MERGED, DEBUG and the pyramid
+    if len(plan) + 2 + PYRAMID_OPEN_FILES > MAX_OPEN_FILES:
+        raise OSError("Participant \"" + participant + "\" has " + str(len(plan)) + " files, too many to merge under MAX_OPEN_FILES")
+
+    sortedFolder = os.path.join(folderPath, SORTED_FOLDER)
+    os.makedirs(sortedFolder, exist_ok=True)
+
+    files = []
+    try:
+        for featureName, name, source in plan:
+            # Sorted copies of compressed sources stay compressed
+            sortedPath = os.path.join(sortedFolder, name)
+            if isinstance(source, tuple) or source.endswith(".gz"):
+                sortedPath += ".gz"
+            # A sorted copy newer than its source (the archive, for a zip member) is reused
+            sourcePath = source[0] if isinstance(source, tuple) else source
+            if not os.path.exists(sortedPath) or os.path.getmtime(sortedPath) <= os.path.getmtime(sourcePath):
+                sortByTime(source, sortedPath)
+            file = fileProcessor(sortedPath, featureName)
+            print("Found", featureName, "File, Name: \"" + name + "\", Size:", file.size)
+            files.append(file)
 
-    print("\nMerged all files into:", newFilePath, "lines:", lineCount)
-    mergeFile.close()
-    debugFile.close()
+        MergeFiles(sorted(files, key=lambda i: i.feature.mergeOrder), folderPath + participant)
+    finally:
+        [file.closeFile() for file in files]
 
 input = os.path.dirname(__file__)
 folderPath = input + "\\"
-fileNames = os.listdir(folderPath)
 
-participantFiles = {}
-mergedNames = []  
+if LIVE:
+    asyncio.run(serveLive(folderPath))
+else:
+    participantPlan = planParticipants(folderPath)
 
-for name in fileNames:
-    for featureName in FEATURENAMES:
-        if featureName in name and name.find(featureName) != -1:
-            mergedName = name[:name.find(featureName)] 
-            if mergedName not in participantFiles:
-                participantFiles[mergedName] = []
-            
-            sortByTime(folderPath + name)  
-            file = fileProcessor(folderPath + name, featureName)  
-            print("Found", featureName, "File, Name: \"" + name + "\", Size:", file.size)
-            participantFiles[mergedName].append(file) 
-            break
-
-for participant in participantFiles:
-    files = sorted(participantFiles[participant], key=lambda i: i.feature.mergeOrder)
-    MergeFiles(files, folderPath + participant)
\ No newline at end of file
+    # A participant that fails to merge is skipped instead of stopping the run for the rest
+    for participant in participantPlan:
+        try:
+            mergeParticipant(participant, participantPlan[participant], folderPath)
+        except Exception as error:
+            print("Skipped participant", participant + ":", repr(error))
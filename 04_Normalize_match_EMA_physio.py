@@ -4,6 +4,9 @@
 import pandas as pd
 import numpy as np
 import os
+import glob
+import hashlib
+import json
 from scipy import stats
 import random
 from datetime import timedelta, datetime
@@ -16,15 +19,63 @@ surv = pd.read_csv('/path/to/survey.csv', parse_dates=['timestamp'], infer_datet
 base = pd.read_csv('/path/to/baseline.csv', parse_dates=['timestamp'], infer_datetime_format=True, index_col=[0])
 ema = pd.read_csv("/path/to/ema.csv", parse_dates=['ethica_time_utc'], infer_datetime_format=True, index_col=[0])
 
+# Cache settings: intermediate signals and window features are stored here, keyed by a hash
+# of the stage's input data and parameters; least recently used entries go first when full
+CACHE_PATH = '/path/to/cache'
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Filter settings
+EDA_FILTER = {'sampling_freq': 4, 'fp': 0.8, 'fs': 1.1, 'ftype': 'ellip', 'delta': 0.02}
+TEMP_SPAN = 60
+
+# Feature settings
+FEATURE_BASES = ['HR', 'EDA', 'TEMP', 'meanCenteredEDA', 'meanCenteredHR', 'meanCenteredTEMP']
+FEATURE_STATS = ['Mean', 'Minimum', 'Maximum', 'Stdev', 'RMS', 'MAD', 'MAV', 'Median', 'P25', 'P75']
+WINDOW_COLUMN = 'event'
+
+# Multi-scale feature settings: window lengths in minutes before each EMA beep, and the
+# histogram sketch used for the approximate Median/P25/P75
+MULTISCALE_WINDOWS = [5, 10, 30, 60]
+SKETCH_BINS = 512
+SKETCH_BLOCK = 240  # Samples per sketch block, 1 minute at 4 Hz
+
+# Cache functions
+def cache_key(stage, df_data, params):
+    key = hashlib.sha1(stage.encode())
+    key.update(pd.util.hash_pandas_object(df_data, index=True).to_numpy().tobytes())
+    key.update(json.dumps(params, sort_keys=True, default=str).encode())
+    return stage + '_' + key.hexdigest()
+
+def evict_cache():
+    entries = sorted(glob.glob(os.path.join(CACHE_PATH, '*.pkl')), key=os.path.getmtime)
+    total = sum(os.path.getsize(entry) for entry in entries)
+    for entry in entries:
+        if total <= CACHE_MAX_BYTES:
+            break
+        total -= os.path.getsize(entry)
+        os.remove(entry)
+
+def cached(stage, df_data, params, compute):
+    path = os.path.join(CACHE_PATH, cache_key(stage, df_data, params) + '.pkl')
+    if os.path.exists(path):
+        os.utime(path)  # Marks the entry as recently used
+        return pd.read_pickle(path)
+    result = compute()
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    result.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    evict_cache()
+    return result
+
 # Filtering functions
 def exp_moving_average(signal, w):
     return pd.Series(signal.ewm(span=w, adjust=True).mean(), signal.index)
 
 def filt_EDA(df_data):
-    eda_data = ph.EvenlySignal(values=df_data['EDA'].to_numpy(), sampling_freq=4, signal_type='EDA')
-    eda_data = ph.IIRFilter(fp=0.8, fs=1.1, ftype='ellip')(eda_data)
+    eda_data = ph.EvenlySignal(values=df_data['EDA'].to_numpy(), sampling_freq=EDA_FILTER['sampling_freq'], signal_type='EDA')
+    eda_data = ph.IIRFilter(fp=EDA_FILTER['fp'], fs=EDA_FILTER['fs'], ftype=EDA_FILTER['ftype'])(eda_data)
     driver = ph.DriverEstim()(eda_data)
-    phasic, tonic, _ = ph.PhasicEstim(delta=0.02)(driver)
+    phasic, tonic, _ = ph.PhasicEstim(delta=EDA_FILTER['delta'])(driver)
     if len(phasic) != len(eda_data.get_values()):
         phasic = np.append(phasic.get_values(), phasic[-1])
         tonic = np.append(tonic.get_values(), tonic[-1])
@@ -33,12 +84,17 @@ def filt_EDA(df_data):
     return df_data  
 
 def filt_TEMP(df_data):
-    df_data['TEMP_Filtered'] = exp_moving_average(df_data['TEMP'], 60)
+    df_data['TEMP_Filtered'] = exp_moving_average(df_data['TEMP'], TEMP_SPAN)
     return df_data
 
 def filter_signals(df_data):
-    df_data = filt_EDA(df_data)
-    df_data = filt_TEMP(df_data)
+    def compute():
+        filtered = filt_TEMP(filt_EDA(df_data[['EDA', 'TEMP']].copy()))
+        return filtered[['Tonic', 'Phasic', 'TEMP_Filtered']]
+    params = {'eda': EDA_FILTER, 'temp_span': TEMP_SPAN}
+    filtered = cached('filter', df_data[['EDA', 'TEMP']], params, compute)
+    for col in filtered.columns:
+        df_data[col] = filtered[col]
     return df_data
 
 # Feature extraction functions
@@ -47,7 +103,7 @@ def rms(data):
 
 def feature_extract(df_data):
     result = {'Time': df_data['timestamp'].min()}
-    for featbase in ['HR', 'EDA', 'TEMP', 'meanCenteredEDA', 'meanCenteredHR', 'meanCenteredTEMP']:
+    for featbase in FEATURE_BASES:
         result[featbase + '_Mean'] = df_data[featbase].mean()
         result[featbase + '_Minimum'] = df_data[featbase].min()
         result[featbase + '_Maximum'] = df_data[featbase].max()
@@ -58,8 +114,126 @@ def feature_extract(df_data):
         result[featbase + '_Median'] = df_data[featbase].median()
         result[featbase + '_P25'] = df_data[featbase].quantile(0.25)
         result[featbase + '_P75'] = df_data[featbase].quantile(0.75)
+    result = {key: value for key, value in result.items() if key == 'Time' or key.rsplit('_', 1)[1] in FEATURE_STATS}
     return pd.Series(result, dtype='object')
 
+def window_features(df_data, params):
+    columns = ['timestamp', WINDOW_COLUMN] + FEATURE_BASES
+    params = dict(params, bases=FEATURE_BASES, stats=FEATURE_STATS, window=WINDOW_COLUMN)
+    compute = lambda: df_data[columns].groupby([WINDOW_COLUMN]).apply(feature_extract)
+    return cached('features', df_data[columns], params, compute)
+
+# Multi-scale window features
+def window_bounds(times, anchors, minutes):
+    # Sample index range [lo, hi) of the window ending just before each anchor
+    hi = np.searchsorted(times, anchors, side='left')
+    lo = np.searchsorted(times, anchors - np.int64(minutes * 60 * 1e9), side='left')
+    return lo, hi
+
+def range_extremes(values, lo, hi):
+    # Min and max of values[lo:hi] for every range, via sparse-table levels: level k holds the
+    # extremes of each run of 2**k samples, and a range is covered by two overlapping runs.
+    # Ranges of every window length are passed together, so each level is built once per
+    # signal, only as high as the longest range needs, and kept only while it is answered.
+    minimum = np.full(len(lo), np.nan)
+    maximum = np.full(len(lo), np.nan)
+    length = hi - lo
+    if not (length > 0).any():
+        return minimum, maximum
+    order = np.floor(np.log2(np.maximum(length, 1))).astype(int)
+    low = high = values
+    k = 0
+    while True:
+        ask = (length > 0) & (order == k)
+        minimum[ask] = np.fmin(low[lo[ask]], low[hi[ask] - 2 ** k])
+        maximum[ask] = np.fmax(high[lo[ask]], high[hi[ask] - 2 ** k])
+        if 2 ** (k + 1) > length.max():
+            return minimum, maximum
+        low = np.fmin(low[:-2 ** k], low[2 ** k:])
+        high = np.fmax(high[:-2 ** k], high[2 ** k:])
+        k += 1
+
+def quantile_sketch(values):
+    # Histogram counts per block of samples, as prefix sums over blocks. NaN samples go to an
+    # extra bin past the last edge that the quantiles never read, as pandas skips them.
+    valid = ~np.isnan(values)
+    low, high = (values[valid].min(), values[valid].max()) if valid.any() else (0.0, 0.0)
+    edges = np.linspace(low, high, SKETCH_BINS + 1)
+    bins = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, SKETCH_BINS - 1)
+    bins[~valid] = SKETCH_BINS
+    nblocks = -(-len(values) // SKETCH_BLOCK)
+    counts = np.zeros((nblocks + 1, SKETCH_BINS + 1))
+    np.add.at(counts, (np.arange(len(values)) // SKETCH_BLOCK + 1, bins), 1)
+    return edges, bins, np.cumsum(counts, axis=0)
+
+def sketch_quantiles(sketch, lo, hi, qs):
+    edges, bins, prefix = sketch
+    # Whole blocks come from the prefix sums, the partial blocks at either end are counted directly
+    first = -(-lo // SKETCH_BLOCK)
+    last = hi // SKETCH_BLOCK
+    if first <= last:
+        counts = prefix[last] - prefix[first]
+        counts = counts + np.bincount(bins[lo:first * SKETCH_BLOCK], minlength=SKETCH_BINS + 1)
+        counts = counts + np.bincount(bins[last * SKETCH_BLOCK:hi], minlength=SKETCH_BINS + 1)
+    else:
+        counts = np.bincount(bins[lo:hi], minlength=SKETCH_BINS + 1).astype(float)
+    counts = counts[:SKETCH_BINS]
+    cum = np.cumsum(counts)
+    if cum[-1] == 0:
+        return [np.nan] * len(qs)
+    # Linear interpolation inside the bin holding each quantile
+    result = []
+    for q in qs:
+        rank = q * cum[-1]
+        b = min(np.searchsorted(cum, rank, side='left'), SKETCH_BINS - 1)
+        below = cum[b] - counts[b]
+        frac = (rank - below) / counts[b] if counts[b] > 0 else 0
+        result.append(edges[b] + frac * (edges[b + 1] - edges[b]))
+    return result
+
+def multiscale_features(df_data, anchors, windows=MULTISCALE_WINDOWS):
+    df_data = df_data.sort_values(['timestamp'])
+    times = pd.DatetimeIndex(df_data['timestamp']).values.astype('datetime64[ns]').astype(np.int64)
+    anchorTimes = pd.DatetimeIndex(anchors)
+    anchorNs = anchorTimes.values.astype('datetime64[ns]').astype(np.int64)
+    bounds = {w: window_bounds(times, anchorNs, w) for w in windows}
+    allLo = np.concatenate([bounds[w][0] for w in windows])
+    allHi = np.concatenate([bounds[w][1] for w in windows])
+
+    result = {'Time': anchorTimes}
+    for featbase in FEATURE_BASES:
+        values = df_data[featbase].to_numpy(dtype=float)
+        # NaN samples are skipped, as in feature_extract: they add nothing to the sums or counts
+        sums = np.concatenate([[0], np.nancumsum(values)])
+        squares = np.concatenate([[0], np.nancumsum(values ** 2)])
+        valid = np.concatenate([[0], np.cumsum(~np.isnan(values))])
+        sketch = quantile_sketch(values)
+        minima, maxima = range_extremes(values, allLo, allHi)
+
+        for i, w in enumerate(windows):
+            lo, hi = bounds[w]
+            n = (valid[hi] - valid[lo]).astype(float)
+            suffix = '_' + str(w) + 'min'
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = sums[hi] - sums[lo]
+                totalSq = squares[hi] - squares[lo]
+                minimum = minima[i * len(anchorNs):(i + 1) * len(anchorNs)]
+                maximum = maxima[i * len(anchorNs):(i + 1) * len(anchorNs)]
+                result[featbase + '_Mean' + suffix] = total / n
+                result[featbase + '_Minimum' + suffix] = minimum
+                result[featbase + '_Maximum' + suffix] = maximum
+                result[featbase + '_Stdev' + suffix] = np.sqrt(np.maximum(totalSq - total ** 2 / n, 0) / (n - 1))
+                result[featbase + '_RMS' + suffix] = np.sqrt(totalSq / n)
+                result[featbase + '_MAV' + suffix] = np.maximum(np.abs(minimum), np.abs(maximum))
+
+            quantiles = np.array([sketch_quantiles(sketch, l, h, [0.5, 0.25, 0.75]) if h > l else [np.nan] * 3
+                                  for l, h in zip(lo, hi)]).reshape(-1, 3)
+            result[featbase + '_Median' + suffix] = quantiles[:, 0]
+            result[featbase + '_P25' + suffix] = quantiles[:, 1]
+            result[featbase + '_P75' + suffix] = quantiles[:, 2]
+
+    return pd.DataFrame(result)
+
 def average_calc(df_data):
     result = {'EDA_Mean': df_data['EDA'].mean(), 'EDA_Median': df_data['EDA'].median(),
               'HR_Mean': df_data['HR'].mean(), 'HR_Median': df_data['HR'].median(),
@@ -103,11 +277,18 @@ for feat in emafeat:
 
 # Prepare physio data for matching
 physio = surv.sort_values(['timestamp'], ignore_index=True)
-physio = physio.groupby(['event']).apply(feature_extract)
+physio = window_features(physio, {'baseline': baseline_values.loc[0].to_dict()})
 
 # Match windows
 mydf = windowMatch(physio, ema)
 
+# Multi-scale features over several window lengths before each beep, from one pass per signal
+columns = ['timestamp'] + FEATURE_BASES
+multiscale = cached('multiscale', surv[columns], {'anchors': list(ema['ethica_time_utc']), 'windows': MULTISCALE_WINDOWS,
+                                                  'bins': SKETCH_BINS, 'block': SKETCH_BLOCK, 'bases': FEATURE_BASES},
+                    lambda: multiscale_features(surv[columns], ema['ethica_time_utc']))
+multiscale = pd.concat([multiscale, ema.reset_index(drop=True)], axis=1)
+
 # Extract features
 featbase = ['HR', 'EDA', 'TEMP', 'meanCenteredEDA', 'meanCenteredHR', 'meanCenteredTEMP']
 featstat = ['_Mean', '_Minimum', '_Stdev', '_RMS', '_MAD', '_MAV', '_Median', '_P25', '_P75']
@@ -129,3 +310,4 @@ ax1 = mydf.plot.scatter(x='HR_Mean', y='restrict')
 surv.to_csv(use_participant + ' Survey Windows CENTERED.csv')
 corr_df.to_csv(use_participant + ' Survey Correlations.csv')
 mydf.to_csv(use_participant + ' Survey Window Summary.csv')
+multiscale.to_csv(use_participant + ' Survey Multiscale Features.csv')